@@ -4,7 +4,7 @@ from numba.core.errors import NumbaDeprecationWarning
 warnings.filterwarnings('ignore', category=NumbaDeprecationWarning)
 warnings.filterwarnings("ignore", "FP16 is not supported on CPU; using FP32 instead")
 
-from fastapi import Depends, FastAPI, File, Form, HTTPException, UploadFile
+from fastapi import Depends, FastAPI, File, Form, Header, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 import mysql.connector
@@ -12,17 +12,28 @@ import os
 import shutil
 import traceback
 import logging
+import logging.handlers
+import json
+import queue
+import atexit
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
 from threading import Lock
-from math import floor
+from math import ceil, floor
 import uuid
 from typing import Generator, Optional
 import time
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
 
+import requests
 from PyPDF2 import PdfReader, PdfWriter
 from werkzeug.utils import secure_filename
 from apscheduler.schedulers.background import BackgroundScheduler
 
+from image_preprocess import detect_image_format, preprocess_image
+
 # --------------------------------------------------------------------------------------
 # Application setup
 # --------------------------------------------------------------------------------------
@@ -50,6 +61,7 @@ transcribe_lock = Lock()
 duration_lock = Lock()
 
 TABLE_OCR = "ocr_files"
+TABLE_SPANS = "ocr_task_spans"
 DATABASE = "ocr_files_db"
 HOST = os.getenv("DB_HOST")
 PORT = os.getenv("MYSQL_CONTAINER_PORT")
@@ -60,11 +72,48 @@ RETRY_INTERVAL = 10
 API_WAITTIME_TIME = 60
 
 log_path = "app.log"
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s:%(name)s - %(message)s",
-    filename=log_path
-)
+
+# リクエスト単位の相関ID。ocr_request で発行し、db_to_queue・OCR API まで引き継ぐ
+correlation_id_var: ContextVar[Optional[str]] = ContextVar("correlation_id", default=None)
+
+TRACE_FIELDS = ("ocr_id", "stage", "duration_ms")
+
+
+class CorrelationIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = correlation_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "correlation_id": getattr(record, "correlation_id", None),
+        }
+        for field in TRACE_FIELDS:
+            if hasattr(record, field):
+                payload[field] = getattr(record, field)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+# ログ出力はキュー経由で別スレッドに任せ、イベントループをファイル I/O でブロックしない
+log_queue: queue.Queue = queue.Queue(-1)
+log_file_handler = logging.FileHandler(log_path, encoding='utf-8')
+log_file_handler.setFormatter(JsonFormatter())
+log_listener = logging.handlers.QueueListener(log_queue, log_file_handler, respect_handler_level=True)
+
+log_queue_handler = logging.handlers.QueueHandler(log_queue)
+log_queue_handler.addFilter(CorrelationIdFilter())
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.handlers = [log_queue_handler]
+
+log_listener.start()
+atexit.register(log_listener.stop)
 os.chmod(log_path, 0o644)
 
 try:
@@ -76,9 +125,22 @@ except Exception:
 SERVER_ADDRESS = os.getenv("SERVER_ADDRESS", "192.168.10.9")
 NGINX_PORT = int(os.getenv("NGINX_PORT", 33380))
 BACKEND_PORT = int(os.getenv("BACKEND_CONTAINER_PORT", 5560))
+DB_TO_QUEUE_URL = os.getenv("DB_TO_QUEUE_URL", "http://db_to_queue:8080")
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(os.path.dirname(__file__), 'input_audio_files'))
+DB_TO_QUEUE_TIMEOUT = 5
 
 scheduler = BackgroundScheduler()
 
+# 画像前処理（縮小・グレースケール化・余白除去・再エンコード）。デプロイごとに切り替え可能
+IMAGE_PREPROCESS_ENABLED = os.getenv("IMAGE_PREPROCESS_ENABLED", "false").lower() in ("1", "true", "yes")
+IMAGE_PREPROCESS_TARGET_DPI = int(os.getenv("IMAGE_PREPROCESS_TARGET_DPI", 300))
+IMAGE_PREPROCESS_GRAYSCALE = os.getenv("IMAGE_PREPROCESS_GRAYSCALE", "true").lower() in ("1", "true", "yes")
+IMAGE_PREPROCESS_AUTO_CROP = os.getenv("IMAGE_PREPROCESS_AUTO_CROP", "true").lower() in ("1", "true", "yes")
+IMAGE_PREPROCESS_JPEG_QUALITY = int(os.getenv("IMAGE_PREPROCESS_JPEG_QUALITY", 85))
+IMAGE_PREPROCESS_WORKERS = int(os.getenv("IMAGE_PREPROCESS_WORKERS", 2))
+
+preprocess_pool: Optional[ProcessPoolExecutor] = None
+
 # --------------------------------------------------------------------------------------
 # Database utilities
 # --------------------------------------------------------------------------------------
@@ -140,9 +202,8 @@ def normalize_page_range(start: Optional[str], end: Optional[str]) -> tuple[Opti
 
 
 def ensure_upload_dir() -> str:
-    upload_dir = os.path.join(os.path.dirname(__file__), 'input_audio_files')
-    os.makedirs(upload_dir, exist_ok=True)
-    return upload_dir
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    return UPLOAD_DIR
 
 
 def save_upload_file(upload: UploadFile, destination: str) -> None:
@@ -192,6 +253,103 @@ def trim_pdf_if_needed(file_path: str, filename: str, file_type: str,
         os.remove(file_path)
         raise HTTPException(status_code=500, detail="PDFのページ抽出に失敗しました")
 
+
+async def preprocess_image_if_enabled(file_path: str, filename: str, file_type: str,
+                                      stored_file_size: int) -> tuple[str, str, int, Optional[str], Optional[str]]:
+    """戻り値の画像形式は (送信するファイルの形式, アップロード時の形式)"""
+    if file_type != 'image':
+        return file_path, filename, stored_file_size, None, None
+
+    if not IMAGE_PREPROCESS_ENABLED or preprocess_pool is None:
+        image_format = detect_image_format(file_path)
+        return file_path, filename, stored_file_size, image_format, image_format
+
+    try:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            preprocess_pool,
+            preprocess_image,
+            file_path,
+            IMAGE_PREPROCESS_TARGET_DPI,
+            IMAGE_PREPROCESS_GRAYSCALE,
+            IMAGE_PREPROCESS_AUTO_CROP,
+            IMAGE_PREPROCESS_JPEG_QUALITY
+        )
+    except Exception as exc:
+        # 前処理に失敗しても元画像のまま OCR に回す
+        logging.error(f"画像の前処理に失敗しました: {file_path} - {exc}")
+        image_format = detect_image_format(file_path)
+        return file_path, filename, stored_file_size, image_format, image_format
+
+    processed_path = result['file_path']
+    logging.info(
+        "Image preprocessed: %s (%s bytes -> %s bytes, saved %s bytes)",
+        processed_path,
+        result['original_size'],
+        result['processed_size'],
+        result['original_size'] - result['processed_size']
+    )
+    return (
+        processed_path,
+        os.path.basename(processed_path),
+        result['processed_size'],
+        result['image_format'],
+        result['original_image_format']
+    )
+
+
+@contextmanager
+def trace_stage(spans: list, stage: str):
+    start_time = datetime.now()
+    try:
+        yield
+    finally:
+        end_time = datetime.now()
+        duration_ms = int((end_time - start_time).total_seconds() * 1000)
+        spans.append((stage, start_time, end_time, duration_ms))
+        logging.info("stage %s finished in %s ms", stage, duration_ms,
+                     extra={"stage": stage, "duration_ms": duration_ms})
+
+
+def save_spans(cursor, ocr_id: int, correlation_id: str, spans: list) -> None:
+    cursor.executemany(f"""
+        INSERT INTO {TABLE_SPANS}
+        (ocr_id, correlation_id, service, stage, start_time, end_time, duration_ms)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    """, [
+        (ocr_id, correlation_id, 'backend', stage, start_time, end_time, duration_ms)
+        for stage, start_time, end_time, duration_ms in spans
+    ])
+
+
+def remove_stored_file(file_path: Optional[str], file_name: Optional[str]) -> None:
+    if not file_path and file_name:
+        file_path = os.path.join(UPLOAD_DIR, file_name)
+
+    if file_path and os.path.exists(file_path):
+        try:
+            os.remove(file_path)
+            logging.info(f"OCRファイルを削除しました: {file_path}")
+        except OSError as file_error:
+            logging.error(f"OCRファイルの削除に失敗しました: {file_path} - {file_error}")
+
+
+def notify_dispatcher_cancel(ocr_id: int) -> bool:
+    try:
+        response = requests.post(f"{DB_TO_QUEUE_URL}/tasks/{ocr_id}/cancel", timeout=DB_TO_QUEUE_TIMEOUT)
+        response.raise_for_status()
+        return True
+    except requests.RequestException as exc:
+        logging.error(f"db_to_queue へのキャンセル通知に失敗しました: ocr_id={ocr_id} - {exc}")
+        return False
+
+
+def percentile(sorted_values: list, ratio: float) -> Optional[int]:
+    if not sorted_values:
+        return None
+    rank = max(1, ceil(ratio * len(sorted_values)))
+    return sorted_values[rank - 1]
+
 # --------------------------------------------------------------------------------------
 # Routes
 # --------------------------------------------------------------------------------------
@@ -204,8 +362,12 @@ async def ocr_request(
     range_start: Optional[str] = Form(None),
     range_end: Optional[str] = Form(None),
     page_count: Optional[str] = Form(None),
+    x_correlation_id: Optional[str] = Header(None),
     connection: mysql.connector.MySQLConnection = Depends(get_db)
 ):
+    task_id = str(uuid.uuid4())
+    correlation_id = (x_correlation_id or task_id)[:64]
+    correlation_id_var.set(correlation_id)
     logging.info(">ocr_request():")
 
     if not file.filename:
@@ -214,8 +376,9 @@ async def ocr_request(
     normalized_file_type = (file_type or 'unknown').lower()
     range_start_value, range_end_value = normalize_page_range(range_start, range_end)
 
+    spans: list = []
+
     try:
-        task_id = str(uuid.uuid4())
         upload_dir = ensure_upload_dir()
 
         sanitized_name = secure_filename(file.filename) or f"{task_id}_{normalized_file_type}"
@@ -223,51 +386,74 @@ async def ocr_request(
         stored_filename = f"{timestamp}_{sanitized_name}"
         stored_path = os.path.join(upload_dir, stored_filename)
 
-        save_upload_file(file, stored_path)
+        with trace_stage(spans, 'upload_save'):
+            save_upload_file(file, stored_path)
         logging.info(f"ファイルを保存しました: {stored_path}")
-
-        stored_path, stored_filename, stored_file_size = trim_pdf_if_needed(
-            stored_path,
-            stored_filename,
-            normalized_file_type,
-            range_start_value,
-            range_end_value
-        )
+        # PDF トリミング・画像前処理の前のサイズ
+        original_file_size = os.path.getsize(stored_path)
+
+        prepare_stage = 'pdf_trim' if normalized_file_type == 'pdf' else 'image_preprocess'
+        with trace_stage(spans, prepare_stage):
+            stored_path, stored_filename, stored_file_size = trim_pdf_if_needed(
+                stored_path,
+                stored_filename,
+                normalized_file_type,
+                range_start_value,
+                range_end_value
+            )
+            (stored_path, stored_filename, stored_file_size,
+             image_format, original_image_format) = await preprocess_image_if_enabled(
+                stored_path,
+                stored_filename,
+                normalized_file_type,
+                stored_file_size
+            )
 
         cursor = connection.cursor()
         insert_query = f"""
             INSERT INTO {TABLE_OCR}
-            (file_name, original_filename, file_path, file_size, file_type,
-             page_count, range_start, range_end, status, upload_time)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            (file_name, original_filename, file_path, file_size, original_file_size, file_type,
+             image_format, original_image_format, page_count, range_start, range_end, status,
+             upload_time, correlation_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
         """
 
         now = datetime.now()
-        cursor.execute(insert_query, (
-            stored_filename,
-            file.filename,
-            stored_path,
-            stored_file_size,
-            normalized_file_type,
-            int(page_count) if page_count else None,
-            range_start_value,
-            range_end_value,
-            'pending',
-            now
-        ))
+        with trace_stage(spans, 'db_insert'):
+            cursor.execute(insert_query, (
+                stored_filename,
+                file.filename,
+                stored_path,
+                stored_file_size,
+                original_file_size,
+                normalized_file_type,
+                image_format,
+                original_image_format,
+                int(page_count) if page_count else None,
+                range_start_value,
+                range_end_value,
+                'pending',
+                now,
+                correlation_id
+            ))
+        task_db_id = cursor.lastrowid
+
+        save_spans(cursor, task_db_id, correlation_id, spans)
 
         connection.commit()
-        task_db_id = cursor.lastrowid
         cursor.close()
+        logging.info("OCR task registered", extra={"ocr_id": task_db_id})
 
         return JSONResponse(
             status_code=200,
             content={
                 "success": True,
                 "task_id": task_db_id,
+                "correlation_id": correlation_id,
                 "message": "OCRリクエストを受け付けました。処理中です",
                 "filename": stored_filename
-            }
+            },
+            headers={"X-Correlation-ID": correlation_id}
         )
     except mysql.connector.Error as db_error:
         logging.error(f"データベースエラー: {db_error}")
@@ -289,9 +475,10 @@ async def get_ocr_status(task_id: int, connection: mysql.connector.MySQLConnecti
     try:
         cursor = connection.cursor(dictionary=True)
         query = f"""
-            SELECT ocr_id, file_name, original_filename, file_path, file_size, file_type,
-                   page_count, range_start, range_end, status, upload_time,
-                   text_content, result_url, error_message, processing_start_time, processing_end_time
+            SELECT ocr_id, file_name, original_filename, file_path, file_size, original_file_size,
+                   file_type, image_format, original_image_format, page_count, range_start, range_end,
+                   status, upload_time, text_content, result_url, error_message,
+                   processing_start_time, processing_end_time
             FROM {TABLE_OCR}
             WHERE ocr_id = %s
         """
@@ -313,6 +500,9 @@ async def get_ocr_status(task_id: int, connection: mysql.connector.MySQLConnecti
                 "file_path": result['file_path'],
                 "file_type": result['file_type'],
                 "file_size": result['file_size'],
+                "original_file_size": result['original_file_size'],
+                "image_format": result['image_format'],
+                "original_image_format": result['original_image_format'],
                 "page_count": result['page_count'],
                 "range_start": result['range_start'],
                 "range_end": result['range_end'],
@@ -335,6 +525,162 @@ async def get_ocr_status(task_id: int, connection: mysql.connector.MySQLConnecti
         raise HTTPException(status_code=500, detail=f"サーバー内部エラーが発生しました: {exc}")
 
 
+@app.delete("/api/aibt/ocr/{task_id}")
+async def cancel_ocr_task(task_id: int, connection: mysql.connector.MySQLConnection = Depends(get_db)):
+    logging.info(f">cancel_ocr_task(): task_id={task_id}")
+
+    try:
+        cursor = connection.cursor(dictionary=True)
+        cursor.execute(f"""
+            SELECT ocr_id, file_name, file_path, status
+            FROM {TABLE_OCR}
+            WHERE ocr_id = %s
+            FOR UPDATE
+        """, (task_id,))
+        result = cursor.fetchone()
+
+        if not result:
+            cursor.close()
+            connection.rollback()
+            raise HTTPException(status_code=404, detail="指定されたタスクは存在しません")
+
+        previous_status = result['status']
+        if previous_status not in ('pending', 'processing'):
+            cursor.close()
+            connection.rollback()
+            raise HTTPException(status_code=409, detail=f"このタスクはキャンセルできません（status={previous_status}）")
+
+        # pending のタスクは fetch_pending_ocr_tasks の対象外になる
+        cursor.execute(f"""
+            UPDATE {TABLE_OCR}
+            SET status = 'canceled',
+                error_message = %s,
+                processing_end_time = NOW()
+            WHERE ocr_id = %s AND status IN ('pending', 'processing')
+        """, ("ユーザーによりキャンセルされました", task_id))
+        connection.commit()
+        cursor.close()
+    except mysql.connector.Error as db_error:
+        logging.error(f"データベースエラー: {db_error}")
+        connection.rollback()
+        raise HTTPException(status_code=500, detail=f"データベース操作に失敗しました: {db_error}")
+    except HTTPException:
+        raise
+    except Exception as exc:
+        logging.error(f"OCRタスクのキャンセルでエラーが発生しました: {exc}")
+        logging.error(traceback.format_exc())
+        connection.rollback()
+        raise HTTPException(status_code=500, detail=f"サーバー内部エラーが発生しました: {exc}")
+
+    # 処理中のタスクは db_to_queue に通知し、OCR API 呼び出しを中断してセマフォを解放させる
+    dispatcher_notified = False
+    if previous_status == 'processing':
+        dispatcher_notified = await asyncio.to_thread(notify_dispatcher_cancel, task_id)
+
+    remove_stored_file(result.get('file_path'), result.get('file_name'))
+
+    return JSONResponse(
+        status_code=200,
+        content={
+            "success": True,
+            "task_id": task_id,
+            "status": "canceled",
+            "previous_status": previous_status,
+            "dispatcher_notified": dispatcher_notified,
+            "message": "OCRタスクをキャンセルしました"
+        }
+    )
+
+
+@app.get("/api/aibt/ocr/spans/{task_id}")
+async def get_ocr_spans(task_id: int, connection: mysql.connector.MySQLConnection = Depends(get_db)):
+    logging.info(f">get_ocr_spans(): task_id={task_id}")
+
+    try:
+        cursor = connection.cursor(dictionary=True)
+        cursor.execute(f"""
+            SELECT correlation_id, service, stage, start_time, end_time, duration_ms
+            FROM {TABLE_SPANS}
+            WHERE ocr_id = %s
+            ORDER BY start_time ASC, span_id ASC
+        """, (task_id,))
+        rows = cursor.fetchall()
+        cursor.close()
+
+        if not rows:
+            raise HTTPException(status_code=404, detail="指定されたタスクのトレース情報は存在しません")
+
+        return JSONResponse(
+            status_code=200,
+            content={
+                "success": True,
+                "task_id": task_id,
+                "correlation_id": rows[0]['correlation_id'],
+                "spans": [
+                    {
+                        "service": row['service'],
+                        "stage": row['stage'],
+                        "start_time": row['start_time'].isoformat(),
+                        "end_time": row['end_time'].isoformat(),
+                        "duration_ms": row['duration_ms']
+                    }
+                    for row in rows
+                ]
+            }
+        )
+    except mysql.connector.Error as db_error:
+        logging.error(f"データベースエラー: {db_error}")
+        raise HTTPException(status_code=500, detail=f"データベースクエリに失敗しました: {db_error}")
+    except HTTPException:
+        raise
+    except Exception as exc:
+        logging.error(f"トレース情報の取得でエラーが発生しました: {exc}")
+        logging.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=f"サーバー内部エラーが発生しました: {exc}")
+
+
+@app.get("/api/aibt/ocr/stage_latency")
+async def get_stage_latency(minutes: int = 60, connection: mysql.connector.MySQLConnection = Depends(get_db)):
+    logging.info(f">get_stage_latency(): minutes={minutes}")
+
+    try:
+        cursor = connection.cursor(dictionary=True)
+        cursor.execute(f"""
+            SELECT service, stage, duration_ms
+            FROM {TABLE_SPANS}
+            WHERE start_time >= %s
+            ORDER BY service, stage, duration_ms
+        """, (datetime.now() - timedelta(minutes=minutes),))
+        rows = cursor.fetchall()
+        cursor.close()
+
+        durations: dict[tuple[str, str], list] = {}
+        for row in rows:
+            durations.setdefault((row['service'], row['stage']), []).append(row['duration_ms'])
+
+        stages = [
+            {
+                "service": service,
+                "stage": stage,
+                "count": len(values),
+                "p50_ms": percentile(values, 0.50),
+                "p95_ms": percentile(values, 0.95),
+                "p99_ms": percentile(values, 0.99),
+                "max_ms": values[-1]
+            }
+            for (service, stage), values in durations.items()
+        ]
+
+        return JSONResponse(status_code=200, content={"success": True, "minutes": minutes, "stages": stages})
+    except mysql.connector.Error as db_error:
+        logging.error(f"データベースエラー: {db_error}")
+        raise HTTPException(status_code=500, detail=f"データベースクエリに失敗しました: {db_error}")
+    except Exception as exc:
+        logging.error(f"ステージ別レイテンシの集計でエラーが発生しました: {exc}")
+        logging.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=f"サーバー内部エラーが発生しました: {exc}")
+
+
 @app.get("/api/estimated_completion_time")
 async def estimated_completion_time(connection: mysql.connector.MySQLConnection = Depends(get_db)):
     try:
@@ -395,18 +741,7 @@ def clean_expired_result_urls() -> None:
     expired_records = cursor.fetchall()
 
     for record in expired_records:
-        file_path = record.get('file_path')
-        file_name = record.get('file_name')
-
-        if not file_path and file_name:
-            file_path = os.path.join(os.path.dirname(__file__), 'input_audio_files', file_name)
-
-        if file_path and os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-                logging.info(f"期限切れのOCRファイルを削除しました: {file_path}")
-            except OSError as file_error:
-                logging.error(f"期限切れOCRファイルの削除に失敗しました: {file_path} - {file_error}")
+        remove_stored_file(record.get('file_path'), record.get('file_name'))
 
     cursor.execute(f"""
         UPDATE `{TABLE_OCR}`
@@ -425,6 +760,10 @@ def clean_expired_result_urls() -> None:
 
 @app.on_event("startup")
 def on_startup() -> None:
+    global preprocess_pool
+    if IMAGE_PREPROCESS_ENABLED and preprocess_pool is None:
+        preprocess_pool = ProcessPoolExecutor(max_workers=IMAGE_PREPROCESS_WORKERS)
+        logging.info(f"Image preprocessing enabled (workers={IMAGE_PREPROCESS_WORKERS}, dpi={IMAGE_PREPROCESS_TARGET_DPI})")
     clean_expired_result_urls()
     if not scheduler.get_jobs():
         scheduler.add_job(clean_expired_result_urls, 'interval', minutes=1, id="cleanup_job", replace_existing=True)
@@ -434,5 +773,9 @@ def on_startup() -> None:
 
 @app.on_event("shutdown")
 def on_shutdown() -> None:
+    global preprocess_pool
     if scheduler.running:
         scheduler.shutdown(wait=False)
+    if preprocess_pool is not None:
+        preprocess_pool.shutdown(wait=False)
+        preprocess_pool = None
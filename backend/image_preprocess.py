@@ -0,0 +1,135 @@
+import os
+from typing import Optional
+
+import numpy as np
+from PIL import Image, ImageOps
+
+# A4 長辺（インチ）。スマホ写真は DPI 情報が当てにならないため、長辺をこの長さに換算して縮小する
+PAGE_LONG_EDGE_INCH = 11.69
+# 余白検出: 背景色との差がこの値を超える画素を「内容」とみなす
+BORDER_DIFF_THRESHOLD = 40
+# 余白トリミング後に残すマージン（px）
+BORDER_MARGIN = 16
+
+# 16bit グレースケール（PNG/TIFF）のモード
+HIGH_BIT_DEPTH_MODES = ('I', 'I;16', 'I;16B', 'I;16L')
+
+FORMAT_ALIASES = {
+    'jpeg': 'jpg',
+    'mpo': 'jpg',
+}
+
+
+def detect_image_format(file_path: str) -> Optional[str]:
+    """画像形式（jpg, png, tiff等）を判定。ヘッダのみ読み込む"""
+    try:
+        with Image.open(file_path) as image:
+            image_format = (image.format or '').lower()
+    except Exception:
+        return None
+    return FORMAT_ALIASES.get(image_format, image_format) or None
+
+
+def find_content_box(gray: np.ndarray) -> Optional[tuple[int, int, int, int]]:
+    """四辺の中央値を背景色とみなし、内容の外接矩形 (left, top, right, bottom) を返す"""
+    border = np.concatenate((gray[0, :], gray[-1, :], gray[:, 0], gray[:, -1]))
+    background = int(np.median(border))
+    mask = np.abs(gray.astype(np.int16) - background) > BORDER_DIFF_THRESHOLD
+
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0 or cols.size == 0:
+        return None
+
+    left = max(int(cols[0]) - BORDER_MARGIN, 0)
+    top = max(int(rows[0]) - BORDER_MARGIN, 0)
+    right = min(int(cols[-1]) + BORDER_MARGIN + 1, gray.shape[1])
+    bottom = min(int(rows[-1]) + BORDER_MARGIN + 1, gray.shape[0])
+    return left, top, right, bottom
+
+
+def flatten_image(image: Image.Image, grayscale: bool) -> Image.Image:
+    """透過画像は白背景に合成し、16bit 画像は 8bit に縮めてから L / RGB に変換する"""
+    if image.mode in HIGH_BIT_DEPTH_MODES:
+        values = np.clip(np.asarray(image, dtype=np.int32), 0, 65535)
+        image = Image.fromarray((values >> 8).astype(np.uint8), 'L')
+
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+    if has_alpha:
+        rgba = image.convert('RGBA')
+        background = Image.new('RGBA', rgba.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, rgba)
+
+    return image.convert('L' if grayscale else 'RGB')
+
+
+def keep_original(file_path: str, image_format: Optional[str], original_size: int) -> dict:
+    return {
+        'file_path': file_path,
+        'image_format': image_format,
+        'original_image_format': image_format,
+        'original_size': original_size,
+        'processed_size': original_size,
+    }
+
+
+def preprocess_image(file_path: str, target_dpi: int = 300, grayscale: bool = True,
+                     auto_crop: bool = True, jpeg_quality: int = 85) -> dict:
+    """OCR 送信前に画像を縮小・グレースケール化・余白除去・再エンコードする
+
+    ProcessPoolExecutor から呼ばれるため、引数と戻り値は pickle 可能な値のみとする。
+    再エンコード結果が元ファイルより大きい場合、変換結果が単色になった場合、
+    変換に失敗した場合は元ファイルをそのまま使う。
+    """
+    original_size = os.path.getsize(file_path)
+    image_format = detect_image_format(file_path)
+    output_path = f"{os.path.splitext(file_path)[0]}_pre.jpg"
+
+    try:
+        processed_size = _write_preprocessed(file_path, output_path, target_dpi, grayscale,
+                                             auto_crop, jpeg_quality)
+    except Exception:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return keep_original(file_path, image_format, original_size)
+
+    if processed_size is None or processed_size >= original_size:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return keep_original(file_path, image_format, original_size)
+
+    os.remove(file_path)
+    return {
+        'file_path': output_path,
+        'image_format': 'jpg',
+        'original_image_format': image_format,
+        'original_size': original_size,
+        'processed_size': processed_size,
+    }
+
+
+def _write_preprocessed(file_path: str, output_path: str, target_dpi: int, grayscale: bool,
+                        auto_crop: bool, jpeg_quality: int) -> Optional[int]:
+    """前処理した JPEG を output_path に書き出してサイズを返す。内容が失われた場合は None"""
+    with Image.open(file_path) as source:
+        image = flatten_image(ImageOps.exif_transpose(source), grayscale)
+
+    max_long_edge = int(PAGE_LONG_EDGE_INCH * target_dpi)
+    long_edge = max(image.size)
+    if long_edge > max_long_edge:
+        scale = max_long_edge / long_edge
+        new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(new_size, Image.LANCZOS)
+
+    if auto_crop:
+        box = find_content_box(np.asarray(image if grayscale else image.convert('L')))
+        if box and box != (0, 0, image.width, image.height):
+            image = image.crop(box)
+
+    # 全画素が同じ値なら変換で文字が消えたとみなす
+    if np.ptp(np.asarray(image)) == 0:
+        return None
+
+    image.save(output_path, 'JPEG', quality=jpeg_quality, optimize=True, dpi=(target_dpi, target_dpi))
+    return os.path.getsize(output_path)
+
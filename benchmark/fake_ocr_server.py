@@ -0,0 +1,127 @@
+"""ベンチマーク用の OCR API スタンドイン
+
+db_to_queue から見て本物の OCR API (POST /ocr) と同じ形のレスポンスを返す。
+処理時間の分布・失敗率・レスポンス形式（markdown_content / merged_markdown / content）を指定できる。
+"""
+import argparse
+import asyncio
+import math
+import os
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+RESPONSE_SHAPES = ("markdown_content", "merged_markdown", "content")
+
+
+def sample_latency(rng: random.Random, dist: str, mean: float, stddev: float) -> float:
+    if dist == "fixed":
+        return mean
+    if dist == "uniform":
+        return rng.uniform(max(0.0, mean - stddev), mean + stddev)
+    if dist == "normal":
+        return max(0.0, rng.gauss(mean, stddev))
+    if dist == "exponential":
+        return rng.expovariate(1.0 / mean) if mean > 0 else 0.0
+    if dist == "lognormal":
+        # 平均・標準偏差が mean / stddev になるよう mu, sigma を求める
+        if mean <= 0:
+            return 0.0
+        variance = stddev ** 2
+        sigma2 = math.log(1 + variance / (mean ** 2))
+        mu = math.log(mean) - sigma2 / 2
+        return rng.lognormvariate(mu, sigma2 ** 0.5)
+    raise ValueError(f"unknown latency distribution: {dist}")
+
+
+def create_app(args: argparse.Namespace) -> web.Application:
+    rng = random.Random(args.seed)
+    stats = {
+        "requests": 0,
+        "failures": 0,
+        "bytes_received": 0,
+        "correlation_ids": 0,
+        "in_flight": 0,
+        "max_in_flight": 0,
+        "latencies": [],
+    }
+    os.makedirs(args.markdown_dir, exist_ok=True)
+
+    async def handle_ocr(request: web.Request) -> web.Response:
+        received_at = time.perf_counter()
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        if request.headers.get("X-Correlation-ID"):
+            stats["correlation_ids"] += 1
+
+        try:
+            form = await request.post()
+            upload = form.get("file")
+            size = len(upload.file.read()) if upload is not None and hasattr(upload, "file") else 0
+            stats["bytes_received"] += size
+
+            latency = sample_latency(rng, args.latency_dist, args.latency_mean, args.latency_stddev)
+            latency += args.latency_per_mb * size / (1024 * 1024)
+            await asyncio.sleep(latency)
+
+            if rng.random() < args.failure_rate:
+                stats["failures"] += 1
+                return web.Response(status=500, text="fake OCR failure")
+
+            shape = args.response_shape if args.response_shape != "mixed" else rng.choice(RESPONSE_SHAPES)
+            markdown = f"# fake OCR result\n\n{size} bytes received\n"
+            body = {"status": "success", "dl_url": f"/static/{uuid.uuid4().hex}.md"}
+            if shape == "merged_markdown":
+                markdown_path = os.path.join(args.markdown_dir, f"{uuid.uuid4().hex}.md")
+                with open(markdown_path, "w", encoding="utf-8") as f:
+                    f.write(markdown)
+                body["merged_markdown"] = markdown_path
+            else:
+                body[shape] = markdown
+            return web.json_response(body)
+        finally:
+            stats["in_flight"] -= 1
+            stats["latencies"].append(time.perf_counter() - received_at)
+
+    async def handle_stats(request: web.Request) -> web.Response:
+        body = {key: value for key, value in stats.items() if key != "latencies"}
+        body["server_time_s"] = sorted(stats["latencies"])
+        return web.json_response(body)
+
+    async def handle_health(request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok"})
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_post("/ocr", handle_ocr)
+    app.router.add_get("/stats", handle_stats)
+    app.router.add_get("/health", handle_health)
+    return app
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--latency-dist", default="lognormal",
+                        choices=("fixed", "uniform", "normal", "exponential", "lognormal"))
+    parser.add_argument("--latency-mean", type=float, default=1.0, help="OCR 処理時間の平均（秒）")
+    parser.add_argument("--latency-stddev", type=float, default=0.3, help="OCR 処理時間の標準偏差（秒）")
+    parser.add_argument("--latency-per-mb", type=float, default=0.0, help="受信 1MB あたりの追加処理時間（秒）")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="HTTP 500 を返す割合 (0.0-1.0)")
+    parser.add_argument("--response-shape", default="markdown_content", choices=RESPONSE_SHAPES + ("mixed",))
+    parser.add_argument("--markdown-dir", default="/tmp/fake_ocr_markdown",
+                        help="merged_markdown 形式で結果ファイルを書き出すディレクトリ")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    web.run_app(create_app(args), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
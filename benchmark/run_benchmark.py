@@ -0,0 +1,544 @@
+"""OCR パイプラインのエンドツーエンド負荷ベンチマーク
+
+MySQL（Docker で起動、または既存サーバー）・フェイク OCR API・backend/AIBT.py・db_to_queue を
+ローカルで起動し、アップロードから OCR 結果保存までを計測する。
+結果は JSON で出力し、--baseline で過去の結果と比較できる。
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from math import ceil
+from typing import Optional
+
+import aiohttp
+import aiomysql
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(REPO_ROOT, "backend")
+DB_TO_QUEUE_DIR = os.path.join(REPO_ROOT, "db_to_queue")
+BENCHMARK_DIR = os.path.join(REPO_ROOT, "benchmark")
+INIT_SQL = os.path.join(REPO_ROOT, "sql", "init.sql")
+
+DATABASE = "ocr_files_db"
+TERMINAL_STATUSES = ("completed", "error", "canceled")
+MYSQL_IMAGE = "mysql:8.0"
+
+# --baseline 比較対象の指標（値が大きいほど悪い）
+LATENCY_METRICS = ("upload_latency_ms", "dispatch_latency_ms", "queue_wait_ms", "end_to_end_ms")
+COMPARED_PERCENTILES = ("p50", "p95", "p99")
+
+
+def log(message: str) -> None:
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] {message}", file=sys.stderr, flush=True)
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values: list, ratio: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    rank = max(1, ceil(ratio * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(values: list) -> dict:
+    values = sorted(values)
+    if not values:
+        return {"count": 0, "mean": None, "p50": None, "p95": None, "p99": None, "max": None}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 3),
+        "p50": round(percentile(values, 0.50), 3),
+        "p95": round(percentile(values, 0.95), 3),
+        "p99": round(percentile(values, 0.99), 3),
+        "max": round(values[-1], 3),
+    }
+
+
+def elapsed_ms(start: datetime, end: datetime) -> float:
+    return (end - start).total_seconds() * 1000
+
+# --------------------------------------------------------------------------------------
+# Process management
+# --------------------------------------------------------------------------------------
+
+class ManagedProcess:
+    def __init__(self, name: str, cmd: list, cwd: str, env: dict, log_dir: str) -> None:
+        self.name = name
+        self.log_path = os.path.join(log_dir, f"{name}.out")
+        self._log_file = open(self.log_path, "wb")
+        self.proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=self._log_file, stderr=subprocess.STDOUT)
+
+    def tail(self, lines: int = 20) -> str:
+        with open(self.log_path, "r", encoding="utf-8", errors="replace") as f:
+            return "".join(f.readlines()[-lines:])
+
+    def stop(self) -> None:
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self._log_file.close()
+
+
+class MySQLStandIn:
+    """Docker の MySQL コンテナ、または既存の MySQL 互換サーバー"""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.use_docker = args.db_host is None
+        self.container_name: Optional[str] = None
+        self.host = args.db_host or "127.0.0.1"
+        # Docker の場合は空きポートに公開し、既存サーバーの場合は MySQL の既定ポートを使う
+        self.port = args.db_port or (free_port() if self.use_docker else 3306)
+        self.password = args.db_password
+        self.allow_reset = args.reset_db
+
+    @property
+    def config(self) -> dict:
+        return {"host": self.host, "port": self.port, "user": "root", "password": self.password, "db": DATABASE}
+
+    def start(self) -> None:
+        if not self.use_docker:
+            return
+        self.container_name = f"aibt_bench_mysql_{uuid.uuid4().hex[:8]}"
+        log(f"Starting {MYSQL_IMAGE} as {self.container_name} on port {self.port}")
+        subprocess.run([
+            "docker", "run", "-d", "--rm",
+            "--name", self.container_name,
+            "-e", f"MYSQL_ROOT_PASSWORD={self.password}",
+            "-p", f"{self.port}:3306",
+            "-v", f"{INIT_SQL}:/docker-entrypoint-initdb.d/init.sql:ro",
+            MYSQL_IMAGE,
+        ], check=True, stdout=subprocess.DEVNULL)
+
+    def stop(self) -> None:
+        if self.container_name:
+            subprocess.run(["docker", "rm", "-f", self.container_name],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    async def wait_until_ready(self, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        last_error: Optional[Exception] = None
+        while time.monotonic() < deadline:
+            try:
+                conn = await aiomysql.connect(**self.config)
+                async with conn.cursor() as cur:
+                    await cur.execute("SELECT 1 FROM ocr_task_spans LIMIT 1")
+                conn.close()
+                return
+            except Exception as exc:
+                last_error = exc
+                await asyncio.sleep(1)
+        raise RuntimeError(f"MySQL did not become ready within {timeout}s: {last_error}")
+
+    async def reset(self) -> None:
+        """ocr_files / ocr_task_spans を空にする。既存サーバーでは --reset-db 指定時のみ削除し、データがあれば中止する"""
+        conn = await aiomysql.connect(**self.config)
+        try:
+            async with conn.cursor() as cur:
+                if not self.use_docker and not self.allow_reset:
+                    await cur.execute(
+                        "SELECT (SELECT COUNT(*) FROM ocr_files) + (SELECT COUNT(*) FROM ocr_task_spans)"
+                    )
+                    (row_count,) = await cur.fetchone()
+                    if row_count:
+                        raise RuntimeError(
+                            f"{self.host}:{self.port} の ocr_files / ocr_task_spans にデータがあります。"
+                            "削除してよい場合は --reset-db を指定してください"
+                        )
+                    return
+                await cur.execute("DELETE FROM ocr_task_spans")
+                await cur.execute("DELETE FROM ocr_files")
+                await conn.commit()
+        finally:
+            conn.close()
+
+
+async def wait_for_http(url: str, process: ManagedProcess, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.proc.poll() is not None:
+                raise RuntimeError(f"{process.name} exited early:\n{process.tail()}")
+            try:
+                async with session.get(url) as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError(f"{process.name} did not become ready within {timeout}s:\n{process.tail()}")
+
+# --------------------------------------------------------------------------------------
+# Load generation and measurement
+# --------------------------------------------------------------------------------------
+
+def load_payload(args: argparse.Namespace) -> tuple[bytes, str]:
+    if args.file:
+        with open(args.file, "rb") as f:
+            return f.read(), os.path.basename(args.file)
+    # 合成ペイロード。ページ範囲を指定しなければ backend は PDF を解析しない
+    payload = b"%PDF-1.4\n" + os.urandom(args.payload_kb * 1024)
+    return payload, "bench.pdf"
+
+
+async def upload_tasks(backend_url: str, payload: bytes, filename: str, args: argparse.Namespace) -> list:
+    semaphore = asyncio.Semaphore(args.upload_concurrency)
+    uploads: list = []
+
+    async def upload_one(session: aiohttp.ClientSession, index: int) -> None:
+        async with semaphore:
+            data = aiohttp.FormData()
+            data.add_field("file", payload, filename=f"{index:05d}_{filename}")
+            data.add_field("file_type", args.file_type)
+            data.add_field("file_size", str(len(payload)))
+            submitted_at = datetime.now()
+            started = time.perf_counter()
+            try:
+                async with session.post(f"{backend_url}/api/aibt/ocr", data=data) as response:
+                    text = await response.text()
+                    ok = response.status == 200
+                # nginx のエラーページ等 JSON 以外の応答は失敗として数え、gather 全体を止めない
+                body = json.loads(text)
+                if not isinstance(body, dict):
+                    raise ValueError(f"unexpected response body: {text[:200]}")
+            except (aiohttp.ClientError, ValueError) as exc:
+                body, ok = {"error": str(exc)}, False
+            uploads.append({
+                "task_id": body.get("task_id") if ok else None,
+                "submitted_at": submitted_at,
+                "latency_ms": (time.perf_counter() - started) * 1000,
+                "ok": ok,
+            })
+
+    timeout = aiohttp.ClientTimeout(total=None)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        await asyncio.gather(*(upload_one(session, index) for index in range(args.tasks)))
+    return uploads
+
+
+async def wait_for_completion(db_config: dict, task_ids: list, timeout: float) -> dict:
+    deadline = time.monotonic() + timeout
+    placeholders = ", ".join(["%s"] * len(task_ids))
+    statuses: dict = {}
+    done = 0
+    while time.monotonic() < deadline:
+        conn = await aiomysql.connect(**db_config)
+        async with conn.cursor() as cur:
+            await cur.execute(
+                f"SELECT ocr_id, status FROM ocr_files WHERE ocr_id IN ({placeholders})", task_ids
+            )
+            statuses = {ocr_id: status for ocr_id, status in await cur.fetchall()}
+        conn.close()
+        done = sum(1 for status in statuses.values() if status in TERMINAL_STATUSES)
+        if done == len(task_ids):
+            break
+        await asyncio.sleep(0.5)
+    else:
+        log(f"Timed out waiting for tasks ({done}/{len(task_ids)} finished)")
+    return statuses
+
+
+async def collect_spans(db_config: dict, task_ids: list) -> list:
+    placeholders = ", ".join(["%s"] * len(task_ids))
+    conn = await aiomysql.connect(**db_config)
+    async with conn.cursor(aiomysql.DictCursor) as cur:
+        await cur.execute(f"""
+            SELECT ocr_id, service, stage, start_time, end_time, duration_ms
+            FROM ocr_task_spans
+            WHERE ocr_id IN ({placeholders})
+        """, task_ids)
+        rows = await cur.fetchall()
+    conn.close()
+    return rows
+
+
+async def fetch_ocr_server_stats(ocr_url: str) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{ocr_url}/stats") as response:
+            stats = await response.json()
+    server_times = stats.pop("server_time_s", [])
+    stats["server_time_ms"] = summarize([value * 1000 for value in server_times])
+    return stats
+
+
+def compute_results(uploads: list, upload_duration_s: float, payload_size: int,
+                    statuses: dict, spans: list) -> dict:
+    spans_by_task: dict = {}
+    for row in spans:
+        spans_by_task.setdefault(row["ocr_id"], {})[(row["service"], row["stage"])] = row
+
+    dispatch_latency, queue_wait, end_to_end = [], [], []
+    for upload in uploads:
+        task_spans = spans_by_task.get(upload["task_id"])
+        if not task_spans:
+            continue
+        db_insert = task_spans.get(("backend", "db_insert"))
+        queued = task_spans.get(("db_to_queue", "queue_wait"))
+        semaphore = task_spans.get(("db_to_queue", "semaphore_wait"))
+        if db_insert and queued:
+            dispatch_latency.append(elapsed_ms(db_insert["end_time"], queued["start_time"]))
+        if queued:
+            queue_wait.append(queued["duration_ms"] + (semaphore["duration_ms"] if semaphore else 0))
+        if statuses.get(upload["task_id"]) == "completed":
+            last_end = max(span["end_time"] for span in task_spans.values())
+            end_to_end.append(elapsed_ms(upload["submitted_at"], last_end))
+
+    stage_durations: dict = {}
+    for row in spans:
+        stage_durations.setdefault(f"{row['service']}.{row['stage']}", []).append(row["duration_ms"])
+
+    succeeded = [upload for upload in uploads if upload["ok"]]
+    outcomes: dict = {}
+    for status in statuses.values():
+        outcomes[status] = outcomes.get(status, 0) + 1
+
+    return {
+        "uploads": {
+            "requested": len(uploads),
+            "succeeded": len(succeeded),
+            "duration_s": round(upload_duration_s, 3),
+            "throughput_rps": round(len(succeeded) / upload_duration_s, 3) if upload_duration_s else None,
+            "throughput_mbps": round(len(succeeded) * payload_size / upload_duration_s / 1024 / 1024, 3)
+            if upload_duration_s else None,
+        },
+        "outcomes": outcomes,
+        "upload_latency_ms": summarize([upload["latency_ms"] for upload in succeeded]),
+        "dispatch_latency_ms": summarize(dispatch_latency),
+        "queue_wait_ms": summarize(queue_wait),
+        "end_to_end_ms": summarize(end_to_end),
+        "stages_ms": {stage: summarize(values) for stage, values in sorted(stage_durations.items())},
+    }
+
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for metric in LATENCY_METRICS:
+        for key in COMPARED_PERCENTILES:
+            old = baseline.get("results", {}).get(metric, {}).get(key)
+            new = results.get(metric, {}).get(key)
+            if old is None or new is None:
+                continue
+            if new > old * (1 + tolerance) and new - old > 1:
+                regressions.append(f"{metric}.{key}: {old} -> {new}")
+    old_rps = baseline.get("results", {}).get("uploads", {}).get("throughput_rps")
+    new_rps = results["uploads"]["throughput_rps"]
+    if old_rps and new_rps is not None and new_rps < old_rps * (1 - tolerance):
+        regressions.append(f"uploads.throughput_rps: {old_rps} -> {new_rps}")
+    return regressions
+
+
+def print_summary(results: dict) -> None:
+    uploads = results["uploads"]
+    log(f"uploads: {uploads['succeeded']}/{uploads['requested']} in {uploads['duration_s']}s "
+        f"({uploads['throughput_rps']} req/s, {uploads['throughput_mbps']} MB/s)")
+    log(f"outcomes: {results['outcomes']}")
+    for metric in LATENCY_METRICS:
+        stats = results[metric]
+        log(f"{metric:<22} p50={stats['p50']} p95={stats['p95']} p99={stats['p99']} (n={stats['count']})")
+    for stage, stats in results["stages_ms"].items():
+        log(f"  {stage:<32} p50={stats['p50']} p95={stats['p95']} p99={stats['p99']}")
+
+# --------------------------------------------------------------------------------------
+# Entry point
+# --------------------------------------------------------------------------------------
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace, workdir: str) -> dict:
+    mysql = MySQLStandIn(args)
+    processes: list = []
+    upload_dir = os.path.join(workdir, "uploads")
+    os.makedirs(upload_dir, exist_ok=True)
+
+    try:
+        mysql.start()
+        await mysql.wait_until_ready(args.startup_timeout)
+        await mysql.reset()
+
+        ocr_port, backend_port, dispatcher_port = free_port(), free_port(), free_port()
+        ocr_url = f"http://127.0.0.1:{ocr_port}"
+        backend_url = f"http://127.0.0.1:{backend_port}"
+        dispatcher_url = f"http://127.0.0.1:{dispatcher_port}"
+
+        ocr_server = ManagedProcess("fake_ocr_server", [
+            sys.executable, os.path.join(BENCHMARK_DIR, "fake_ocr_server.py"),
+            "--port", str(ocr_port),
+            "--latency-dist", args.ocr_latency_dist,
+            "--latency-mean", str(args.ocr_latency_mean),
+            "--latency-stddev", str(args.ocr_latency_stddev),
+            "--latency-per-mb", str(args.ocr_latency_per_mb),
+            "--failure-rate", str(args.ocr_failure_rate),
+            "--response-shape", args.ocr_response_shape,
+            "--markdown-dir", os.path.join(workdir, "markdown"),
+            "--seed", str(args.seed),
+        ], cwd=workdir, env=dict(os.environ), log_dir=workdir)
+        processes.append(ocr_server)
+
+        db_env = {
+            "DB_HOST": mysql.host,
+            "MYSQL_CONTAINER_PORT": str(mysql.port),
+            "DB_PASSWORD": mysql.password,
+        }
+        backend = ManagedProcess("backend", [
+            sys.executable, "-m", "uvicorn", "AIBT:app", "--app-dir", BACKEND_DIR,
+            "--host", "127.0.0.1", "--port", str(backend_port), "--log-level", "warning",
+        ], cwd=workdir, env={
+            **os.environ, **db_env,
+            "UPLOAD_DIR": upload_dir,
+            "DB_TO_QUEUE_URL": dispatcher_url,
+            "IMAGE_PREPROCESS_ENABLED": "true" if args.image_preprocess else "false",
+        }, log_dir=workdir)
+        processes.append(backend)
+
+        dispatcher = ManagedProcess("db_to_queue", [
+            sys.executable, "-m", "uvicorn", "db_to_queue:app", "--app-dir", DB_TO_QUEUE_DIR,
+            "--host", "127.0.0.1", "--port", str(dispatcher_port), "--log-level", "warning",
+        ], cwd=workdir, env={
+            **os.environ, **db_env,
+            "OCR_API_URL": f"{ocr_url}/ocr",
+            "FILE_BASE_PATH": upload_dir,
+            "LOG_PATH": os.path.join(workdir, "db_to_queue.log"),
+            "CONCURRENT_REQUESTS": str(args.concurrent_requests),
+            "QUEUE_MAX_SIZE": str(args.queue_max_size),
+            "CHECK_INTERVAL": str(args.check_interval),
+            "TAG": "bench",
+        }, log_dir=workdir)
+        processes.append(dispatcher)
+
+        await wait_for_http(f"{ocr_url}/health", ocr_server, args.startup_timeout)
+        await wait_for_http(f"{backend_url}/api/estimated_completion_time", backend, args.startup_timeout)
+        await wait_for_http(f"{dispatcher_url}/health", dispatcher, args.startup_timeout)
+
+        payload, filename = load_payload(args)
+        log(f"Uploading {args.tasks} tasks ({len(payload)} bytes each, concurrency {args.upload_concurrency})")
+        upload_started = time.perf_counter()
+        uploads = await upload_tasks(backend_url, payload, filename, args)
+        upload_duration_s = time.perf_counter() - upload_started
+
+        task_ids = [upload["task_id"] for upload in uploads if upload["task_id"] is not None]
+        if not task_ids:
+            raise RuntimeError(f"No upload succeeded:\n{backend.tail()}")
+
+        log(f"Waiting for {len(task_ids)} tasks to finish")
+        statuses = await wait_for_completion(mysql.config, task_ids, args.completion_timeout)
+        spans = await collect_spans(mysql.config, task_ids)
+
+        results = compute_results(uploads, upload_duration_s, len(payload), statuses, spans)
+        results["ocr_server"] = await fetch_ocr_server_stats(ocr_url)
+        return results
+    finally:
+        for process in reversed(processes):
+            process.stop()
+        mysql.stop()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    load = parser.add_argument_group("load")
+    load.add_argument("--tasks", type=int, default=50, help="投入するタスク数")
+    load.add_argument("--upload-concurrency", type=int, default=8, help="同時アップロード数")
+    load.add_argument("--file", help="アップロードするファイル（省略時は合成 PDF）")
+    load.add_argument("--file-type", default="pdf", choices=("pdf", "image"))
+    load.add_argument("--payload-kb", type=int, default=512, help="合成 PDF のサイズ（KB）")
+    load.add_argument("--image-preprocess", action="store_true", help="backend の画像前処理を有効化")
+
+    dispatcher = parser.add_argument_group("db_to_queue")
+    dispatcher.add_argument("--concurrent-requests", type=int, default=1)
+    dispatcher.add_argument("--queue-max-size", type=int, default=1)
+    dispatcher.add_argument("--check-interval", type=float, default=5)
+
+    ocr = parser.add_argument_group("fake OCR API")
+    ocr.add_argument("--ocr-latency-dist", default="lognormal",
+                     choices=("fixed", "uniform", "normal", "exponential", "lognormal"))
+    ocr.add_argument("--ocr-latency-mean", type=float, default=0.5)
+    ocr.add_argument("--ocr-latency-stddev", type=float, default=0.2)
+    ocr.add_argument("--ocr-latency-per-mb", type=float, default=0.0)
+    ocr.add_argument("--ocr-failure-rate", type=float, default=0.0)
+    ocr.add_argument("--ocr-response-shape", default="markdown_content",
+                     choices=("markdown_content", "merged_markdown", "content", "mixed"))
+
+    db = parser.add_argument_group("MySQL (省略時は Docker で mysql:8.0 を起動)")
+    db.add_argument("--db-host", help="既存の MySQL 互換サーバー。init.sql 適用済みであること")
+    db.add_argument("--db-port", type=int, help="省略時は --db-host 指定なら 3306、Docker なら空きポート")
+    db.add_argument("--db-password", default="bench")
+    db.add_argument("--reset-db", action="store_true",
+                    help="--db-host のサーバーの ocr_files / ocr_task_spans を実行前に削除する")
+
+    output = parser.add_argument_group("output")
+    output.add_argument("--output", help="結果 JSON の出力先（省略時は標準出力）")
+    output.add_argument("--baseline", help="比較対象の結果 JSON。悪化があれば終了コード 1")
+    output.add_argument("--tolerance", type=float, default=0.10, help="悪化とみなす割合")
+    output.add_argument("--keep-workdir", action="store_true", help="ログ・アップロードファイルを残す")
+
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--startup-timeout", type=float, default=120)
+    parser.add_argument("--completion-timeout", type=float, default=600)
+    return parser
+
+
+def main() -> int:
+    args = build_parser().parse_args()
+    workdir = tempfile.mkdtemp(prefix="aibt_bench_")
+    log(f"Working directory: {workdir}")
+
+    started_at = datetime.now()
+    results = asyncio.run(run(args, workdir))
+    print_summary(results)
+
+    report = {
+        "started_at": started_at.isoformat(),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "results": results,
+    }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        report["regressions"] = regressions
+        for regression in regressions:
+            log(f"REGRESSION {regression}")
+        exit_code = 1 if regressions else 0
+
+    report_json = json.dumps(report, ensure_ascii=False, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report_json + "\n")
+        log(f"Results written to {args.output}")
+    else:
+        print(report_json)
+
+    if not args.keep_workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,11 +2,21 @@ import asyncio
 import aiomysql
 import aiohttp
 import os
+import json
+import queue
+import uuid
+import atexit
 import logging
+import logging.handlers
+from contextvars import ContextVar
+from datetime import datetime
+from types import SimpleNamespace
 from typing import Optional
+from urllib.parse import urljoin
 
 from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
 
 DB_CONFIG = {
     'user': 'root',
@@ -16,11 +26,39 @@ DB_CONFIG = {
     'port': int(os.getenv('MYSQL_CONTAINER_PORT'))
 }
 
-CONCURRENT_REQUESTS = 1
-QUEUE_MAX_SIZE = 1
-CHECK_INTERVAL = 5
+# ベンチマーク等で調整できるよう環境変数で上書き可能
+CONCURRENT_REQUESTS = int(os.getenv('CONCURRENT_REQUESTS', 1))
+QUEUE_MAX_SIZE = int(os.getenv('QUEUE_MAX_SIZE', 1))
+CHECK_INTERVAL = float(os.getenv('CHECK_INTERVAL', 5))
+
+log_path = os.getenv('LOG_PATH', "/logs/db_to_queue.log")
+
+# backend の ocr_request で発行された相関ID。処理中のタスク単位で設定する
+correlation_id_var: ContextVar[Optional[str]] = ContextVar("correlation_id", default=None)
+
+TRACE_FIELDS = ("ocr_id", "stage", "duration_ms")
+
+
+class CorrelationIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = correlation_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "correlation_id": getattr(record, "correlation_id", None),
+        }
+        for field in TRACE_FIELDS:
+            if hasattr(record, field):
+                payload[field] = getattr(record, field)
+        return json.dumps(payload, ensure_ascii=False, default=str)
 
-log_path = "/logs/db_to_queue.log"
 
 logger = logging.getLogger("db_to_queue")
 logger.setLevel(logging.INFO)
@@ -32,17 +70,171 @@ if not logger.handlers:
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
 
-    formatter = logging.Formatter("%(asctime)s - %(levelname)s:%(name)s - %(message)s")
+    formatter = JsonFormatter()
     file_handler.setFormatter(formatter)
     console_handler.setFormatter(formatter)
 
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    # ハンドラの書き込みは QueueListener のスレッドで行い、イベントループをブロックしない
+    log_queue: queue.Queue = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(CorrelationIdFilter())
+    log_listener = logging.handlers.QueueListener(
+        log_queue, file_handler, console_handler, respect_handler_level=True
+    )
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+    logger.addHandler(queue_handler)
+    logger.propagate = False
 
 logger.info("Logging has been initialized successfully.")
 
-API_URL = f"http://ocr-api:5000/ocr"
-FILE_BASE_PATH = "/var/www/backend/input_audio_files"  # Docker container path
+API_URL = os.getenv('OCR_API_URL', "http://ocr-api:5000/ocr")
+# /ready で疎通確認する URL。未指定時は OCR_API_URL と同じホストの /health
+OCR_API_HEALTH_URL = os.getenv('OCR_API_HEALTH_URL') or urljoin(API_URL, '/health')
+FILE_BASE_PATH = os.getenv('FILE_BASE_PATH', "/var/www/backend/input_audio_files")  # Docker container path
+
+# キューに投入済みで処理が終わっていないタスクID、そのうちキャンセル要求を受けたタスクID、
+# 実行中の OCR API 呼び出し（ocr_id -> asyncio.Task）
+claimed_task_ids: set = set()
+canceled_task_ids: set = set()
+in_flight_requests: dict = {}
+
+READINESS_TIMEOUT = 3
+
+# --------------------------------------------------------------------------------------
+# Prometheus metrics (/metrics)
+# --------------------------------------------------------------------------------------
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+BYTES_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(8))  # 64KB ~ 1GB
+
+FETCH_CYCLES = Counter(
+    'ocr_dispatcher_fetch_cycles_total', 'fetch_pending_ocr_tasks loop iterations', ['result']
+)
+FETCH_STAGE_SECONDS = Histogram(
+    'ocr_dispatcher_fetch_stage_seconds',
+    'Duration of each fetch loop step (connect, select, claim = UPDATE + commit, enqueue = queue.put)',
+    ['stage'], buckets=LATENCY_BUCKETS
+)
+TASKS_CLAIMED = Counter('ocr_dispatcher_tasks_claimed_total', 'Tasks moved from pending to processing')
+TASK_OUTCOMES = Counter(
+    'ocr_dispatcher_task_outcomes_total',
+    'Task results by branch of process_ocr_task (completed, still_processing, json_parse_failure, ...)',
+    ['outcome']
+)
+STAGE_SECONDS = Histogram(
+    'ocr_dispatcher_stage_seconds', 'Duration of each task stage recorded in ocr_task_spans',
+    ['stage'], buckets=LATENCY_BUCKETS
+)
+OCR_API_RESPONSES = Counter('ocr_dispatcher_ocr_api_responses_total', 'OCR API responses', ['status_code'])
+# _sum が送信バイト数の合計になる
+BYTES_SENT = Histogram('ocr_dispatcher_sent_bytes', 'File bytes sent to the OCR API per task', buckets=BYTES_BUCKETS)
+SEMAPHORE_IN_USE = Gauge('ocr_dispatcher_semaphore_in_use', 'OCR request slots currently held')
+CONCURRENCY_LIMIT = Gauge('ocr_dispatcher_concurrency_limit', 'CONCURRENT_REQUESTS setting')
+QUEUE_CAPACITY = Gauge('ocr_dispatcher_queue_capacity', 'QUEUE_MAX_SIZE setting')
+IN_FLIGHT_REQUESTS = Gauge('ocr_dispatcher_in_flight_requests', 'OCR API calls currently running')
+
+CONCURRENCY_LIMIT.set(CONCURRENT_REQUESTS)
+QUEUE_CAPACITY.set(QUEUE_MAX_SIZE)
+IN_FLIGHT_REQUESTS.set_function(lambda: sum(1 for task in in_flight_requests.values() if not task.done()))
+
+
+class CountingSemaphore:
+    """使用中のスロット数を in_use で参照できる asyncio.Semaphore"""
+
+    def __init__(self, value: int) -> None:
+        self._semaphore = asyncio.Semaphore(value)
+        self.in_use = 0
+
+    async def __aenter__(self) -> None:
+        await self._semaphore.acquire()
+        self.in_use += 1
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.in_use -= 1
+        self._semaphore.release()
+
+
+def release_task(ocr_id) -> None:
+    """処理を終えたタスクをキャンセル管理の対象から外す"""
+    claimed_task_ids.discard(ocr_id)
+    canceled_task_ids.discard(ocr_id)
+
+
+def dispatch_filename(original_filename: Optional[str], file_name: str) -> str:
+    """OCR API に渡すファイル名。backend の前処理で再エンコードされた場合は拡張子を保存ファイルに合わせる"""
+    if not original_filename:
+        return file_name
+    stem, original_ext = os.path.splitext(original_filename)
+    stored_ext = os.path.splitext(file_name)[1]
+    if stored_ext and stored_ext.lower() != original_ext.lower():
+        return f"{stem}{stored_ext}"
+    return original_filename
+
+
+def observe_fetch_stage(stage: str, start_time: datetime) -> None:
+    FETCH_STAGE_SECONDS.labels(stage=stage).observe((datetime.now() - start_time).total_seconds())
+
+
+def add_span(spans: list, stage: str, start_time: datetime, end_time: Optional[datetime] = None) -> None:
+    """ステージの処理時間を記録し、構造化ログにも出力"""
+    end_time = end_time or datetime.now()
+    duration_ms = max(0, int((end_time - start_time).total_seconds() * 1000))
+    spans.append((stage, start_time, end_time, duration_ms))
+    STAGE_SECONDS.labels(stage=stage).observe((end_time - start_time).total_seconds())
+    logger.info("stage %s finished in %s ms", stage, duration_ms,
+                extra={"stage": stage, "duration_ms": duration_ms})
+
+
+async def save_spans(ocr_id, correlation_id, spans: list) -> None:
+    """ステージ別の処理時間を ocr_task_spans に保存"""
+    if not spans:
+        return
+    try:
+        conn = await aiomysql.connect(**DB_CONFIG)
+        try:
+            async with conn.cursor() as cur:
+                await cur.executemany("""
+                    INSERT INTO ocr_task_spans
+                    (ocr_id, correlation_id, service, stage, start_time, end_time, duration_ms)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                """, [
+                    (ocr_id, correlation_id, 'db_to_queue', stage, start_time, end_time, duration_ms)
+                    for stage, start_time, end_time, duration_ms in spans
+                ])
+                await conn.commit()
+        finally:
+            conn.close()
+    except Exception as exc:
+        logger.error(f"Error saving task spans: {exc}")
+
+
+async def on_request_start(session, trace_config_ctx, params) -> None:
+    ctx = trace_config_ctx.trace_request_ctx
+    if ctx is not None:
+        ctx.request_start = datetime.now()
+
+
+async def on_request_chunk_sent(session, trace_config_ctx, params) -> None:
+    ctx = trace_config_ctx.trace_request_ctx
+    if ctx is not None:
+        ctx.upload_end = datetime.now()
+
+
+async def on_request_end(session, trace_config_ctx, params) -> None:
+    ctx = trace_config_ctx.trace_request_ctx
+    if ctx is not None:
+        ctx.response_start = datetime.now()
+
+
+def create_trace_config() -> aiohttp.TraceConfig:
+    """multipart 送信完了とレスポンスヘッダ受信の時刻を取得し、アップロードと OCR API 処理時間を分離する"""
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_chunk_sent.append(on_request_chunk_sent)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
 
 
 async def fetch_pending_ocr_tasks(queue: asyncio.Queue, stop_event: asyncio.Event):
@@ -50,12 +242,16 @@ async def fetch_pending_ocr_tasks(queue: asyncio.Queue, stop_event: asyncio.Even
         if queue.qsize() < QUEUE_MAX_SIZE:
             conn: Optional[aiomysql.Connection] = None
             try:
+                connect_start = datetime.now()
                 conn = await aiomysql.connect(**DB_CONFIG)
+                observe_fetch_stage('connect', connect_start)
                 async with conn.cursor() as cur:
+                    query_start = datetime.now()
                     await cur.execute(
                         """
                         SELECT ocr_id, file_name, original_filename, file_path, file_type,
-                               page_count, range_start, range_end, user_name
+                               page_count, range_start, range_end, user_name,
+                               upload_time, correlation_id
                         FROM ocr_files
                         WHERE status='pending'
                         ORDER BY upload_time ASC
@@ -64,23 +260,40 @@ async def fetch_pending_ocr_tasks(queue: asyncio.Queue, stop_event: asyncio.Even
                         (QUEUE_MAX_SIZE - queue.qsize(),)
                     )
                     tasks = await cur.fetchall()
+                    observe_fetch_stage('select', query_start)
                     for task in tasks:
+                        claim_update_start = datetime.now()
                         await cur.execute(
-                            "UPDATE ocr_files SET status='processing', processing_start_time=NOW() WHERE ocr_id=%s",
+                            "UPDATE ocr_files SET status='processing', processing_start_time=NOW() "
+                            "WHERE ocr_id=%s AND status='pending'",
                             (task[0],)
                         )
                         await conn.commit()
-                        await queue.put(task)
+                        observe_fetch_stage('claim', claim_update_start)
+                        # SELECT 後にキャンセルされたタスクはキューに入れない
+                        if cur.rowcount == 0:
+                            continue
+                        TASKS_CLAIMED.inc()
+                        claimed_task_ids.add(task[0])
+                        # SELECT 開始・キュー投入時刻を付けて渡し、db_wait / claim / queue_wait を計測する
+                        enqueued_at = datetime.now()
+                        await queue.put((task, query_start, enqueued_at))
+                        observe_fetch_stage('enqueue', enqueued_at)
+                        correlation_id_var.set(task[10])
                         logger.info(
                             "OCR Task %s added to queue with file_name %s, file_type %s. Queue size now %s",
-                            task[0], task[1], task[4], queue.qsize()
+                            task[0], task[1], task[4], queue.qsize(), extra={"ocr_id": task[0]}
                         )
+                    correlation_id_var.set(None)
+                FETCH_CYCLES.labels(result='ok').inc()
             except Exception as exc:
+                FETCH_CYCLES.labels(result='error').inc()
                 logger.error(f"Error fetching OCR tasks from database: {exc}")
             finally:
                 if conn:
                     conn.close()
         else:
+            FETCH_CYCLES.labels(result='queue_full').inc()
             logger.info("Queue is full, waiting for space to become available.")
 
         try:
@@ -91,7 +304,7 @@ async def fetch_pending_ocr_tasks(queue: asyncio.Queue, stop_event: asyncio.Even
     logger.info("Fetch task loop stopped.")
 
 
-async def process_ocr_task(queue: asyncio.Queue, semaphore: asyncio.Semaphore,
+async def process_ocr_task(queue: asyncio.Queue, semaphore: CountingSemaphore,
                            session: aiohttp.ClientSession, stop_event: asyncio.Event):
     while not stop_event.is_set():
         try:
@@ -103,32 +316,73 @@ async def process_ocr_task(queue: asyncio.Queue, semaphore: asyncio.Semaphore,
             queue.task_done()
             break
 
+        task, claim_start, enqueued_at = task
+        (ocr_id, file_name, original_filename, file_path, file_type, page_count,
+         range_start, range_end, user_name, upload_time, correlation_id) = task
+        correlation_id = correlation_id or uuid.uuid4().hex
+        correlation_id_var.set(correlation_id)
+
+        if ocr_id in canceled_task_ids:
+            release_task(ocr_id)
+            TASK_OUTCOMES.labels(outcome='canceled').inc()
+            logger.info(f"OCR task {ocr_id} was canceled while queued; skipped.", extra={"ocr_id": ocr_id})
+            queue.task_done()
+            correlation_id_var.set(None)
+            continue
+
+        spans: list = []
+        if upload_time and upload_time <= claim_start:
+            add_span(spans, 'db_wait', upload_time, claim_start)
+        elif upload_time:
+            # backend と db_to_queue の時刻がずれている。0 に丸めず記録しない
+            logger.warning(f"upload_time {upload_time} is later than claim start {claim_start}; db_wait skipped.",
+                           extra={"ocr_id": ocr_id})
+        add_span(spans, 'claim', claim_start, enqueued_at)
+        add_span(spans, 'queue_wait', enqueued_at)
+
+        semaphore_wait_start = datetime.now()
         async with semaphore:
-            ocr_id, file_name, original_filename, file_path, file_type, page_count, range_start, range_end, user_name = task
+            add_span(spans, 'semaphore_wait', semaphore_wait_start)
 
             logger.info(
                 "Processing OCR task %s with file_name %s, file_type %s, user_name %s. Queue size before processing: %s",
-                ocr_id, file_name, file_type, user_name, queue.qsize()
+                ocr_id, file_name, file_type, user_name, queue.qsize(), extra={"ocr_id": ocr_id}
             )
 
             try:
+                # セマフォ待ちの間にキャンセルされた場合は送信しない
+                if ocr_id in canceled_task_ids:
+                    logger.info(f"OCR task {ocr_id} was canceled before dispatch; skipped.",
+                                extra={"ocr_id": ocr_id})
+                    release_task(ocr_id)
+                    TASK_OUTCOMES.labels(outcome='canceled').inc()
+                    await save_spans(ocr_id, correlation_id, spans)
+                    queue.task_done()
+                    continue
+
                 # 完全なファイルパスを構築
                 full_file_path = os.path.join(FILE_BASE_PATH, file_name)
 
                 # ファイルが存在するか確認
                 if not os.path.exists(full_file_path):
                     logger.error(f"File not found: {full_file_path}")
+                    TASK_OUTCOMES.labels(outcome='file_not_found').inc()
                     await update_task_status(ocr_id, 'error', f"File not found: {full_file_path}")
+                    release_task(ocr_id)
+                    await save_spans(ocr_id, correlation_id, spans)
                     queue.task_done()
                     continue
 
                 # ファイル内容を読み込む
+                file_read_start = datetime.now()
                 with open(full_file_path, 'rb') as f:
                     file_content = f.read()
+                add_span(spans, 'file_read', file_read_start)
+                BYTES_SENT.observe(len(file_content))
 
                 # フォームデータを準備
                 data = aiohttp.FormData()
-                data.add_field('file', file_content, filename=original_filename or file_name,
+                data.add_field('file', file_content, filename=dispatch_filename(original_filename, file_name),
                               content_type='application/pdf' if file_type == 'pdf' else 'image/*')
                 data.add_field('file_type', file_type)
                 data.add_field('file_size', str(os.path.getsize(full_file_path)))
@@ -144,85 +398,148 @@ async def process_ocr_task(queue: asyncio.Queue, semaphore: asyncio.Semaphore,
                         data.add_field('range_end', str(range_end))
                     data.add_field('page_count', str(page_count))
 
-                async with session.post(API_URL, data=data) as response:
-                    if response.status == 200:
-                        logger.info(f"OCR task {ocr_id} sent to API successfully.")
-                        try:
-                            response_data = await response.json()
-                            logger.info(f"API Response: {response_data}")
-
-                            # OCR処理が完了したか確認
-                            if response_data.get('status') == 'success':
-                                # OCR結果を抽出
-                                ocr_result = ""
-                                result_url = ""
-
-                                # 異なるフィールドからOCR結果を取得しようとする
-                                if 'markdown_content' in response_data:
-                                    ocr_result = response_data['markdown_content']
-                                elif 'content' in response_data:
-                                    ocr_result = response_data['content']
-                                elif 'merged_markdown' in response_data:
-                                    # 返されたファイルパスからファイル内容を読み込む必要がある
-                                    merged_markdown_path = response_data['merged_markdown']
-                                    try:
-                                        # 共有静的ファイルディレクトリから直接ファイル内容を読み込む
-                                        full_file_path = merged_markdown_path  # パスは既に /static/... の形式
-                                        with open(full_file_path, 'r', encoding='utf-8') as f:
-                                            ocr_result = f.read()
-                                        logger.info(f"Successfully read OCR result from {full_file_path}")
-                                    except Exception as file_error:
-                                        logger.error(f"Error reading merged markdown file {merged_markdown_path}: {file_error}")
-
-                                if 'dl_url' in response_data:
-                                    result_url = response_data['dl_url']
-
-                                # データベースステータスをcompletedに更新し、OCR結果を保存
-                                await update_task_status_with_result(ocr_id, 'completed', ocr_result, result_url)
-                            else:
-                                # OCR処理中、processingステータスを維持
-                                logger.info(f"OCR task {ocr_id} is still processing...")
-
-                        except Exception as json_error:
-                            logger.error(f"Failed to parse JSON response: {json_error}")
-                            response_text = await response.text()
-                            logger.info(f"API Response (text): {response_text}")
-                            # 解析に失敗しても処理完了とみなす（APIが200を返したため）
-                            await update_task_status(ocr_id, 'completed')
-                    else:
-                        logger.error(f"Failed to send OCR task {ocr_id} to API: {response.status}")
-                        error_text = await response.text()
-                        logger.error(f"Response: {error_text}")
-                        await update_task_status(ocr_id, 'error', f"API error: {response.status}")
+                # キャンセル API から中断できるよう、OCR API 呼び出しを別タスクで実行
+                request_task = asyncio.create_task(
+                    send_ocr_request(ocr_id, session, data, correlation_id, spans)
+                )
+                in_flight_requests[ocr_id] = request_task
+                try:
+                    await request_task
+                except asyncio.CancelledError:
+                    if ocr_id not in canceled_task_ids:
+                        raise
+                    TASK_OUTCOMES.labels(outcome='canceled').inc()
+                    logger.info(f"OCR task {ocr_id} was canceled during the OCR API request.",
+                                extra={"ocr_id": ocr_id})
+                finally:
+                    in_flight_requests.pop(ocr_id, None)
 
             except Exception as e:
                 logger.error(f"Exception occurred while processing OCR task {ocr_id}: {e}")
+                TASK_OUTCOMES.labels(outcome='exception').inc()
                 await update_task_status(ocr_id, 'error', str(e))
 
+            release_task(ocr_id)
+            await save_spans(ocr_id, correlation_id, spans)
             queue.task_done()
-            logger.info(f"Finished processing OCR task {ocr_id}. Queue size after processing: {queue.qsize()}")
+            logger.info(f"Finished processing OCR task {ocr_id}. Queue size after processing: {queue.qsize()}",
+                        extra={"ocr_id": ocr_id})
+        correlation_id_var.set(None)
 
     logger.info("Process task loop stopped.")
 
+
+async def send_ocr_request(ocr_id, session: aiohttp.ClientSession, data: aiohttp.FormData,
+                           correlation_id: str, spans: list) -> None:
+    """OCR API へ送信し、結果をデータベースに反映する"""
+    request_ctx = SimpleNamespace(request_start=None, upload_end=None, response_start=None)
+    spans_recorded = False
+    try:
+        async with session.post(API_URL, data=data,
+                                headers={'X-Correlation-ID': correlation_id},
+                                trace_request_ctx=request_ctx) as response:
+            record_request_spans(spans, request_ctx)
+            spans_recorded = True
+            OCR_API_RESPONSES.labels(status_code=str(response.status)).inc()
+            response_read_start = datetime.now()
+            if response.status == 200:
+                logger.info(f"OCR task {ocr_id} sent to API successfully.")
+                try:
+                    response_data = await response.json()
+                    add_span(spans, 'ocr_response_read', response_read_start)
+                    logger.info(f"API Response: {response_data}")
+
+                    # OCR処理が完了したか確認
+                    if response_data.get('status') == 'success':
+                        # OCR結果を抽出
+                        ocr_result = ""
+                        result_url = ""
+
+                        # 異なるフィールドからOCR結果を取得しようとする
+                        if 'markdown_content' in response_data:
+                            ocr_result = response_data['markdown_content']
+                        elif 'content' in response_data:
+                            ocr_result = response_data['content']
+                        elif 'merged_markdown' in response_data:
+                            # 返されたファイルパスからファイル内容を読み込む必要がある
+                            merged_markdown_path = response_data['merged_markdown']
+                            try:
+                                # 共有静的ファイルディレクトリから直接ファイル内容を読み込む
+                                full_file_path = merged_markdown_path  # パスは既に /static/... の形式
+                                with open(full_file_path, 'r', encoding='utf-8') as f:
+                                    ocr_result = f.read()
+                                logger.info(f"Successfully read OCR result from {full_file_path}")
+                            except Exception as file_error:
+                                logger.error(f"Error reading merged markdown file {merged_markdown_path}: {file_error}")
+
+                        if 'dl_url' in response_data:
+                            result_url = response_data['dl_url']
+
+                        # データベースステータスをcompletedに更新し、OCR結果を保存
+                        result_update_start = datetime.now()
+                        await update_task_status_with_result(ocr_id, 'completed', ocr_result, result_url)
+                        add_span(spans, 'result_update', result_update_start)
+                        TASK_OUTCOMES.labels(outcome='completed').inc()
+                    else:
+                        # OCR処理中、processingステータスを維持
+                        TASK_OUTCOMES.labels(outcome='still_processing').inc()
+                        logger.info(f"OCR task {ocr_id} is still processing...")
+
+                except Exception as json_error:
+                    logger.error(f"Failed to parse JSON response: {json_error}")
+                    TASK_OUTCOMES.labels(outcome='json_parse_failure').inc()
+                    response_text = await response.text()
+                    logger.info(f"API Response (text): {response_text}")
+                    # 解析に失敗しても処理完了とみなす（APIが200を返したため）
+                    await update_task_status(ocr_id, 'completed')
+            else:
+                logger.error(f"Failed to send OCR task {ocr_id} to API: {response.status}")
+                TASK_OUTCOMES.labels(outcome='api_error').inc()
+                error_text = await response.text()
+                logger.error(f"Response: {error_text}")
+                await update_task_status(ocr_id, 'error', f"API error: {response.status}")
+    finally:
+        # タイムアウト・接続エラー・キャンセルでレスポンスヘッダを受信できなかった場合も記録する
+        if not spans_recorded:
+            record_request_spans(spans, request_ctx)
+
+
+def record_request_spans(spans: list, request_ctx: SimpleNamespace) -> None:
+    """TraceConfig で取得した時刻から ocr_upload / ocr_api のスパンを記録
+
+    レスポンスヘッダを受信する前に中断された場合は、送信完了から現在までを ocr_api_aborted とする
+    """
+    if not request_ctx.request_start:
+        return
+    upload_end = request_ctx.upload_end or request_ctx.request_start
+    add_span(spans, 'ocr_upload', request_ctx.request_start, upload_end)
+    if request_ctx.response_start:
+        add_span(spans, 'ocr_api', upload_end, request_ctx.response_start)
+    else:
+        add_span(spans, 'ocr_api_aborted', upload_end)
+
+
 async def update_task_status(ocr_id, status, error_message=None):
     """タスクステータスを更新"""
     try:
         conn = await aiomysql.connect(**DB_CONFIG)
-        async with conn.cursor() as cur:
-            if error_message:
-                await cur.execute("""
-                    UPDATE ocr_files
-                    SET status=%s, error_message=%s, processing_end_time=NOW()
-                    WHERE ocr_id=%s
-                """, (status, error_message, ocr_id))
-            else:
-                await cur.execute("""
-                    UPDATE ocr_files
-                    SET status=%s, processing_end_time=NOW()
-                    WHERE ocr_id=%s
-                """, (status, ocr_id))
-            await conn.commit()
-        conn.close()
+        try:
+            async with conn.cursor() as cur:
+                if error_message:
+                    await cur.execute("""
+                        UPDATE ocr_files
+                        SET status=%s, error_message=%s, processing_end_time=NOW()
+                        WHERE ocr_id=%s AND status<>'canceled'
+                    """, (status, error_message, ocr_id))
+                else:
+                    await cur.execute("""
+                        UPDATE ocr_files
+                        SET status=%s, processing_end_time=NOW()
+                        WHERE ocr_id=%s AND status<>'canceled'
+                    """, (status, ocr_id))
+                await conn.commit()
+        finally:
+            conn.close()
     except Exception as exc:
         logger.error(f"Error updating task status: {exc}")
 
@@ -230,14 +547,16 @@ async def update_task_status_with_result(ocr_id, status, ocr_result=None, result
     """タスクステータスを更新し、OCR結果を保存"""
     try:
         conn = await aiomysql.connect(**DB_CONFIG)
-        async with conn.cursor() as cur:
-            await cur.execute("""
-                UPDATE ocr_files
-                SET status=%s, text_content=%s, result_url=%s, processing_end_time=NOW()
-                WHERE ocr_id=%s
-            """, (status, ocr_result, result_url, ocr_id))
-            await conn.commit()
-        conn.close()
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute("""
+                    UPDATE ocr_files
+                    SET status=%s, text_content=%s, result_url=%s, processing_end_time=NOW()
+                    WHERE ocr_id=%s AND status<>'canceled'
+                """, (status, ocr_result, result_url, ocr_id))
+                await conn.commit()
+        finally:
+            conn.close()
         logger.info(f"Task {ocr_id} completed successfully with OCR result saved to database")
     except Exception as exc:
         logger.error(f"Error updating task status with result: {exc}")
@@ -245,11 +564,11 @@ async def update_task_status_with_result(ocr_id, status, ocr_result=None, result
         await update_task_status(ocr_id, status)
 
 
-async def process_ocr_queue(queue: asyncio.Queue, stop_event: asyncio.Event, worker_count: int):
+async def process_ocr_queue(queue: asyncio.Queue, semaphore: CountingSemaphore,
+                            stop_event: asyncio.Event, worker_count: int):
     timeout = aiohttp.ClientTimeout(total=1200)  # 20分 = 1200秒
-    semaphore = asyncio.Semaphore(CONCURRENT_REQUESTS)
 
-    async with aiohttp.ClientSession(timeout=timeout) as session:
+    async with aiohttp.ClientSession(timeout=timeout, trace_configs=[create_trace_config()]) as session:
         tasks = [
             asyncio.create_task(process_ocr_task(queue, semaphore, session, stop_event))
             for _ in range(worker_count)
@@ -260,6 +579,7 @@ async def process_ocr_queue(queue: asyncio.Queue, stop_event: asyncio.Event, wor
 class QueueWorker:
     def __init__(self) -> None:
         self.queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_MAX_SIZE)
+        self.semaphore = CountingSemaphore(CONCURRENT_REQUESTS)
         self.stop_event = asyncio.Event()
         self.tasks: list[asyncio.Task] = []
         self.worker_count = max(1, QUEUE_MAX_SIZE)
@@ -271,7 +591,9 @@ class QueueWorker:
 
         self.stop_event.clear()
         fetch_task = asyncio.create_task(fetch_pending_ocr_tasks(self.queue, self.stop_event))
-        process_task = asyncio.create_task(process_ocr_queue(self.queue, self.stop_event, self.worker_count))
+        process_task = asyncio.create_task(
+            process_ocr_queue(self.queue, self.semaphore, self.stop_event, self.worker_count)
+        )
         self.tasks = [fetch_task, process_task]
         logger.info("Queue worker started.")
 
@@ -293,6 +615,10 @@ class QueueWorker:
 
 worker = QueueWorker()
 
+QUEUE_SIZE = Gauge('ocr_dispatcher_queue_size', 'Tasks waiting in the in-memory queue')
+QUEUE_SIZE.set_function(lambda: worker.queue.qsize())
+SEMAPHORE_IN_USE.set_function(lambda: worker.semaphore.in_use)
+
 app = FastAPI(title="OCR Task Queue", version="1.0.0")
 
 
@@ -309,6 +635,56 @@ async def shutdown_event() -> None:
     await worker.stop()
 
 
+async def mark_task_canceled(ocr_id) -> Optional[str]:
+    """pending / processing のタスクを canceled に更新し、更新後のステータスを返す（タスクがなければ None）"""
+    conn = await aiomysql.connect(**DB_CONFIG)
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                UPDATE ocr_files
+                SET status='canceled', error_message=%s, processing_end_time=NOW()
+                WHERE ocr_id=%s AND status IN ('pending', 'processing')
+            """, ("ユーザーによりキャンセルされました", ocr_id))
+            await conn.commit()
+            await cur.execute("SELECT status FROM ocr_files WHERE ocr_id=%s", (ocr_id,))
+            row = await cur.fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+@app.post("/tasks/{ocr_id}/cancel")
+async def cancel_task(ocr_id: int) -> JSONResponse:
+    # backend 以外から呼ばれても行が processing のまま残らないよう、先に DB を canceled にする
+    try:
+        status = await mark_task_canceled(ocr_id)
+    except Exception as exc:
+        logger.error(f"Error marking OCR task {ocr_id} as canceled: {exc}", extra={"ocr_id": ocr_id})
+        return JSONResponse(status_code=500, content={"status": "error", "ocr_id": ocr_id, "detail": str(exc)})
+    if status is None:
+        return JSONResponse(status_code=404, content={"status": "error", "ocr_id": ocr_id, "detail": "task not found"})
+    if status != 'canceled':
+        return JSONResponse(
+            status_code=409,
+            content={"status": "error", "ocr_id": ocr_id, "detail": f"task cannot be canceled (status={status})"}
+        )
+
+    # キュー投入前・処理完了後のタスクは DB の status='canceled' だけで足りるため記録しない
+    tracked = ocr_id in claimed_task_ids
+    if tracked:
+        canceled_task_ids.add(ocr_id)
+    request_task = in_flight_requests.get(ocr_id)
+    in_flight = request_task is not None and not request_task.done()
+    if in_flight:
+        request_task.cancel()
+    logger.info(f"Cancel requested for OCR task {ocr_id} (tracked={tracked}, in_flight={in_flight})",
+                extra={"ocr_id": ocr_id})
+    return JSONResponse(
+        status_code=200,
+        content={"status": "ok", "ocr_id": ocr_id, "tracked": tracked, "in_flight": in_flight}
+    )
+
+
 @app.get("/health")
 async def health_check() -> JSONResponse:
     return JSONResponse(
@@ -316,6 +692,64 @@ async def health_check() -> JSONResponse:
         content={
             "status": "ok",
             "queue_size": worker.queue.qsize() if worker.queue else 0,
+            "queue_capacity": QUEUE_MAX_SIZE,
+            "in_flight": sorted(ocr_id for ocr_id, task in in_flight_requests.items() if not task.done()),
+            "semaphore_in_use": worker.semaphore.in_use,
+            "concurrency_limit": CONCURRENT_REQUESTS,
             "running": any(not task.done() for task in worker.tasks)
         }
     )
+
+
+async def check_database() -> Optional[str]:
+    """DB に接続できれば None、できなければエラー内容を返す"""
+    try:
+        conn = await asyncio.wait_for(aiomysql.connect(**DB_CONFIG), timeout=READINESS_TIMEOUT)
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT 1")
+        finally:
+            conn.close()
+        return None
+    except Exception as exc:
+        return str(exc) or type(exc).__name__
+
+
+async def check_ocr_api() -> Optional[str]:
+    """OCR API のヘルスチェック URL が 5xx 以外を返せば None、それ以外はエラー内容を返す
+
+    到達性のみの確認のため、/health を持たない OCR API（404）も ready とみなす
+    """
+    try:
+        timeout = aiohttp.ClientTimeout(total=READINESS_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.get(OCR_API_HEALTH_URL) as response:
+                await response.read()
+                if response.status >= 500:
+                    return f"{OCR_API_HEALTH_URL} returned HTTP {response.status}"
+        return None
+    except Exception as exc:
+        return str(exc) or type(exc).__name__
+
+
+@app.get("/ready")
+async def readiness_check() -> JSONResponse:
+    db_error, ocr_api_error = await asyncio.gather(check_database(), check_ocr_api())
+    running = any(not task.done() for task in worker.tasks)
+    ready = running and db_error is None and ocr_api_error is None
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "status": "ready" if ready else "not_ready",
+            "checks": {
+                "worker": "ok" if running else "stopped",
+                "database": db_error or "ok",
+                "ocr_api": ocr_api_error or "ok"
+            }
+        }
+    )
+
+
+@app.get("/metrics")
+async def metrics() -> Response:
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
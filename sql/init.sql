@@ -11,23 +11,43 @@ CREATE TABLE ocr_files (
     original_filename VARCHAR(255), -- 元のファイル名
     file_path VARCHAR(500), -- ファイル保存パス
     file_size BIGINT, -- ファイルサイズ（バイト単位）
+    original_file_size BIGINT, -- アップロード時（PDF トリミング・画像前処理前）のファイルサイズ（バイト単位）
     file_type ENUM('pdf', 'image') NOT NULL, -- ファイルタイプ
-    image_format VARCHAR(50), -- 画像形式（jpg, png, tiff等）
+    image_format VARCHAR(50), -- 画像形式（jpg, png, tiff等）。前処理で再エンコードした場合は jpg
+    original_image_format VARCHAR(50), -- アップロード時の画像形式
     page_count INT, -- PDFの総ページ数
     range_start INT, -- OCR処理開始ページ
     range_end INT, -- OCR処理終了ページ
     text_content LONGTEXT, -- OCR結果テキスト
     status ENUM('pending', 'processing', 'completed', 'error', 'canceled') NOT NULL DEFAULT 'pending',
-    upload_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    upload_time TIMESTAMP(3) DEFAULT CURRENT_TIMESTAMP(3), -- db_wait 計測のためミリ秒精度
     processing_start_time TIMESTAMP NULL,
     processing_end_time TIMESTAMP NULL,
     processing_duration INT NULL, -- 処理時間（秒）
     result_url VARCHAR(255),
     error_message TEXT, -- エラーメッセージ
+    correlation_id VARCHAR(64), -- 相関ID（backend → db_to_queue → OCR API で共通）
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
 -- インデックスの作成（パフォーマンス向上のため）
 CREATE INDEX idx_ocr_files_status ON ocr_files(status);
 CREATE INDEX idx_ocr_files_upload_time ON ocr_files(upload_time);
-CREATE INDEX idx_ocr_files_file_type ON ocr_files(file_type);
\ No newline at end of file
+CREATE INDEX idx_ocr_files_file_type ON ocr_files(file_type);
+CREATE INDEX idx_ocr_files_correlation_id ON ocr_files(correlation_id);
+
+-- タスクのステージ別処理時間（トレース）
+CREATE TABLE ocr_task_spans (
+    span_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    ocr_id INT NOT NULL,
+    correlation_id VARCHAR(64),
+    service VARCHAR(50) NOT NULL, -- 記録したサービス（backend, db_to_queue）
+    stage VARCHAR(50) NOT NULL, -- ステージ名（upload_save, db_wait, claim, queue_wait, ocr_api 等）
+    start_time DATETIME(3) NOT NULL,
+    end_time DATETIME(3) NOT NULL,
+    duration_ms INT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_ocr_task_spans_ocr_id ON ocr_task_spans(ocr_id);
+CREATE INDEX idx_ocr_task_spans_start_time ON ocr_task_spans(start_time);
\ No newline at end of file